@@ -2,6 +2,7 @@
 Support for Lenco DIR150BK and other Airmusic based Internet Radios.
 """
 import logging
+import time
 import requests
 import xmltodict
 
@@ -60,14 +61,25 @@ class airmusic(object):
            12, 'Reading from file',
            14, 'failed to connect', }
 
-    def __init__(self, device_address, timeout=5):
+    # The Basic Authentication credentials. These are hardcoded in the device.
+    AUTH = ('su3g4go6sk7', 'ji39454xu/^')
+
+    # Commands and keys that may change the play mode. After sending one, the mode is unknown
+    # until the next init().
+    MODE_COMMANDS = ('GotoFMfav', 'playDABhotkey', 'playhotkey', 'play_stn', 'LocalPlay', 'BTCMD',
+                     'StartBTMatch')
+    MODE_KEYS = (KEY_POWER, KEY_MODE, KEY_USB, KEY_INTERNETRADIO)
+
+    def __init__(self, device_address, timeout=5, port=80):
         """!
         Constructor of the Airmusic API class.
         @param device_address holds the device IP-address or resolvable name.
         @param timeout determines the maximum amount of seconds to wait for a reply from the device.
+        @param port is the default http port to send commands to. Use it to talk to a proxy.
         """
         self.device_address = device_address
         self.timeout = timeout
+        self.port = port
         logging.basicConfig(level=logging.INFO,
                             format='[%(asctime)s] %(levelname)-8s %(name)-12s %(message)s',
                             filename=('airmusic-debug.log'),)
@@ -78,6 +90,7 @@ class airmusic(object):
         self.push_talk = None
         self.play_mode = None
         self.sw_update = None
+        self.mode_time = None  # Time (time.monotonic()) the play mode was read.
 
     def __del__(self):
         """!
@@ -96,6 +109,7 @@ class airmusic(object):
         ret = ""
         ret += "Airmusic API Ver. {}".format(VERSION)
         ret += "\n  address={}".format(self.device_address)
+        ret += "\n  port={}".format(self.port)
         ret += "\n  timeout={}".format(self.timeout)
         ret += "\n  language={}".format(self.language)
         ret += "\n  hotkey={}".format(self.hotkey_fav)
@@ -111,7 +125,7 @@ class airmusic(object):
         """
         return self.__repr__()
 
-    def send_cmd(self, cmd, port=80, params=None):
+    def send_cmd(self, cmd, port=None, params=None):
         """!
         Send the command and optional parameters to the device and receive the response.
         Most commands will be sent to port 80, but some might require port 8080.
@@ -122,22 +136,27 @@ class airmusic(object):
         In that case, parameter cmd will be set to 'list', and parameter params will be set to
         the dict(id=1, start=1, count=15).
         @param cmd is the command to send.
-        @param port is the http port to send the command to. Default is 80.
+        @param port is the http port to send the command to. Default is the port given to the constructor.
         @param params holds the command parameters (as a dict).
         """
         # The parameters for the command, if any, are received in a dict() structure.
         if type(params) is not dict:
             params = dict()
+        if port is None:
+            port = self.port
         if self.logger:
             self.logger.debug("Sending: {}".format(cmd))
         # Send the command to the device. The Basic Authentication values are hardcoded.
         result = requests.get('http://{}:{}/{}'.format(self.device_address, port, cmd),
-                              auth=('su3g4go6sk7', 'ji39454xu/^'),
+                              auth=self.AUTH,
                               params=params,
                               timeout=self.timeout)
         if self.logger:
             self.logger.debug("Response: headers={}, text=\"{}\"".format(result.headers, result.text))
         if result.ok:
+            if cmd in self.MODE_COMMANDS or (cmd == 'Sendkey' and
+                                             int(params.get('key', 0)) in self.MODE_KEYS):
+                self.play_mode = None
             if 'html' in result.text:  # Some commands, like set_dname, return an HTML page.
                 return dict(result='OK')
             return xmltodict.parse(make_xml(result.text))
@@ -277,6 +296,7 @@ class airmusic(object):
         self.hotkey_fav = result['hotkey_fav']
         self.push_talk = result['push_talk']
         self.play_mode = result['PlayMode']
+        self.mode_time = time.monotonic()
         self.sw_update = result['SWUpdate']
         return result
 
@@ -493,6 +513,67 @@ class airmusic(object):
             return resp['result']
         return dict(result=resp['result'])
 
+    def get_state(self, max_age=60):
+        """!
+        Return the state of the device, polling only the command relevant for the play mode.
+        The play mode is known from init(). Commands that may change the mode (like playhotkey,
+        or the KEY_MODE, KEY_USB and KEY_INTERNETRADIO keys) make the mode unknown, and so does a
+        reply that belongs to another mode, eg. an FM status while playinfo was expected. An unknown or outdated mode is read again with init().
+        Depending on the mode, one of these is polled:
+         - FM : get_FM_status(),
+         - Bluetooth : get_BT_status(),
+         - any other mode : get_playinfo().
+        The following tags are returned; tags that do not apply to the mode are None:
+         - mode : the play mode (PlayMode of init()),
+         - vol : the volume level (int),
+         - mute : the mute state (bool),
+         - sid : the play status (int), see SID,
+         - status : the play status text, or the error text if playinfo failed,
+         - station, artist, song : the station name, artist and song,
+         - freq, signal, sound, rds : the FM frequency in MHz (float), the signal level (int),
+           MONO/STEREO and RDS info,
+         - bt_status : the bluetooth status value.
+        A mode change made with the buttons or the remote control is only noticed when the reply
+        belongs to another mode, or after max_age seconds.
+        @param max_age is the number of seconds after which the play mode is read again.
+        @return a dict holding the state.
+        """
+        if self.mode_time is None or time.monotonic() - self.mode_time > max_age:
+            self.play_mode = None
+        if self.play_mode is None:
+            self.init(language=self.language or 'en')
+        state = dict(mode=self.play_mode, vol=None, mute=None, sid=None, status=None, station=None,
+                     artist=None, song=None, freq=None, signal=None, sound=None, rds=None, bt_status=None)
+        mode = (self.play_mode or '').upper()
+        if 'FM' in mode:
+            resp = self.get_FM_status()
+            resp = resp if isinstance(resp, dict) else dict()
+            state.update(freq=round(float(resp['Freq']), 2) if resp.get('Freq') else None,
+                         signal=int(resp['Signal']) if resp.get('Signal') else None,
+                         sound=resp.get('Sound'), rds=resp.get('RDS'))
+            fits = bool(resp.get('Freq'))
+        elif 'BT' in mode or 'BLUETOOTH' in mode:
+            resp = self.get_BT_status()
+            resp = resp if isinstance(resp, dict) else dict()
+            state.update(bt_status=resp.get('Status'))
+            fits = 'Status' in resp
+        else:
+            resp = self.get_playinfo()
+            status = resp.get('status') or resp.get('result')
+            # An idle or failing device replies with an error, which fits every mode but FM and BT.
+            fits = 'vol' in resp or not (isinstance(status, dict) and ('Freq' in status or 'Status' in status))
+            if isinstance(status, dict):
+                status = status.get('rt') or str(status)
+            state.update(sid=int(resp['sid']) if resp.get('sid') else None,
+                         status=status, station=resp.get('station_info'),
+                         artist=resp.get('artist'), song=resp.get('song'))
+        if 'vol' in resp:
+            state.update(vol=int(resp['vol']), mute=resp.get('mute') == '1')
+        if not fits:
+            # The reply does not fit the mode; maybe it was changed. Read it again next time.
+            self.play_mode = None
+        return state
+
     def get_systeminfo(self):
         """!
         Fetch firmware and network info.
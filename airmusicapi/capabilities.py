@@ -0,0 +1,205 @@
+"""
+Capability probing for Airmusic based Internet Radios.
+
+Different Airmusic models support different subsets of the commands, eg. only some have DAB,
+Bluetooth or FM. Sending an unsupported command costs a full round trip or a timeout, and the
+reply has an unexpected shape.
+The capabilities class probes each capability once with a read-only command, and stores the result
+in a JSON file keyed by the firmware version (the version tag of init()), so devices with the same
+firmware are never probed again. After attach(), the commands of an unsupported capability raise
+notsupported without sending anything to the device.
+
+The result of init() is stored in the same file. If a device was initialised recently with the same
+language, attach() restores that result instead of sending init again.
+
+Usage:
+  caps = capabilities()
+  caps.attach(am_obj)
+  if caps.supports(am_obj, 'DAB'):
+      print(am_obj.get_DAB_hotkeylist())
+"""
+import json
+import logging
+import os
+import threading
+import time
+from xml.parsers.expat import ExpatError
+
+
+# Capability -> (probe command, check of the reply, commands that need the capability).
+PROBES = {
+    'FM': ('GetFMStatus',
+           lambda resp: isinstance(resp.get('result'), dict) and 'Freq' in resp['result'],
+           ('GetFMStatus', 'GetFMFAVlist', 'SetFMManualsearch', 'SetFMMode', 'GotoFMfav')),
+    'DAB': ('DABhotkeylist',
+            lambda resp: 'menu' in resp,
+            ('DABhotkeylist', 'playDABhotkey')),
+    'BT': ('GetBTStatus',
+           lambda resp: isinstance(resp.get('result'), dict) and 'Status' in resp['result'],
+           ('GetBTStatus', 'BTCMD', 'StartBTMatch')),
+}
+
+# Flags reported by init() that are stored with the probe results.
+INIT_FLAGS = ('M7_SUPPORT', 'SMS_SUPPORT', 'MKEY_SUPPORT', 'UART_CD')
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.airmusic-capabilities.json')
+
+
+class notsupported(Exception):
+    """
+    Raised when a command is sent that the device does not support.
+    """
+
+
+class capabilities(object):
+    """
+    This class probes, caches and enforces the capabilities of Airmusic devices.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, handshake_age=600):
+        """!
+        Constructor of the capability cache.
+        @param path is the name of the JSON file holding the cached results.
+        @param handshake_age is the number of seconds the result of init() stays valid.
+        """
+        self.path = path
+        self.handshake_age = handshake_age
+        self.logger = logging.getLogger("airmusic.capabilities")
+        self._lock = threading.Lock()
+        self.cache = dict(firmware=dict(), handshakes=dict())
+        if os.path.exists(path):
+            with open(path) as handle:
+                self.cache.update(json.load(handle))
+
+    def _save(self):
+        """!
+        @private
+        Write the cache file. Must be called with self._lock held.
+        """
+        temp_file = self.path + '.tmp'
+        with open(temp_file, 'w') as handle:
+            json.dump(self.cache, handle, indent=2, sort_keys=True)
+        os.replace(temp_file, self.path)
+
+    def handshake(self, api, language='en'):
+        """!
+        Initialise the session with the device, unless it was done recently.
+        If a recent result of init() with the same language is cached, the attributes of the API
+        instance are restored from it and no command is sent.
+        @param api is an Airmusic API instance.
+        @param language holds the communication language, eg. en, fr, de, nl, ...
+        @return a dict holding the system parameters and values, see airmusic.init().
+        """
+        with self._lock:
+            cached = self.cache['handshakes'].get(api.device_address)
+        if cached and cached['language'] == language and time.time() - cached['time'] < self.handshake_age:
+            result = cached['result']
+            api.language = result['lang']
+            api.hotkey_fav = result['hotkey_fav']
+            api.push_talk = result['push_talk']
+            api.play_mode = result['PlayMode']
+            api.mode_time = time.monotonic() - (time.time() - cached['time'])
+            api.sw_update = result['SWUpdate']
+            return result
+        result = api.init(language=language)
+        with self._lock:
+            self.cache['handshakes'][api.device_address] = dict(time=time.time(), language=language,
+                                                                result=dict(result))
+            self._save()
+        return result
+
+    def probe(self, api, flags=None):
+        """!
+        Probe all capabilities of a device by sending one read-only command for each.
+        A capability is unsupported if the device returns a reply without the expected tags. An HTTP
+        error or a reply that cannot be parsed, eg. while the device is busy, proves nothing: the
+        capability is reported as None. If the device does not respond, the exception is passed on.
+        @param api is an Airmusic API instance.
+        @param flags is the dict returned by init(); its support flags are added to the result.
+        @return a dict capability -> True/False/None, plus the init() support flags.
+        """
+        # Probe past the guard of an earlier attach(), which blocks the probe commands themselves.
+        send_cmd = getattr(api, '_unguarded_send_cmd', api.send_cmd)
+        result = dict()
+        for name, (cmd, check, _) in sorted(PROBES.items()):
+            try:
+                resp = send_cmd(cmd)
+                result[name] = check(resp) if resp is not None else None
+            except ExpatError:
+                result[name] = None
+            self.logger.debug("{}: {} supported: {}".format(api.device_address, name, result[name]))
+        for flag in INIT_FLAGS:
+            if flags and flag in flags:
+                result[flag] = flags[flag]
+        return result
+
+    def attach(self, api, language='en'):
+        """!
+        Determine the capabilities of a device and block its unsupported commands.
+        The device is only probed if no results are cached for its firmware version. The results are
+        only cached if all capabilities could be determined; an undetermined capability is allowed.
+        @param api is an Airmusic API instance.
+        @param language holds the communication language, eg. en, fr, de, nl, ...
+        @return a dict capability -> True/False/None (undetermined).
+        """
+        info = self.handshake(api, language)
+        version = info.get('version') or 'unknown'
+        with self._lock:
+            found = self.cache['firmware'].get(version)
+        if found is None:
+            found = self.probe(api, info)
+            if None not in found.values():
+                with self._lock:
+                    self.cache['firmware'][version] = found
+                    self._save()
+        api.capabilities = found
+        blocked = set()
+        for name, (_, _, cmds) in PROBES.items():
+            if found.get(name) is False:
+                blocked.update(cmds)
+        self._guard(api, blocked)
+        return found
+
+    @staticmethod
+    def _guard(api, blocked):
+        """!
+        @private
+        Make the given commands of the API instance fail without network traffic.
+        """
+        send_cmd = getattr(api, '_unguarded_send_cmd', api.send_cmd)
+        api._unguarded_send_cmd = send_cmd
+        address = api.device_address
+
+        def guarded_send_cmd(cmd, port=None, params=None):
+            if cmd in blocked:
+                raise notsupported("{} does not support {}".format(address, cmd))
+            return send_cmd(cmd, port=port, params=params)
+
+        api.send_cmd = guarded_send_cmd
+
+    @staticmethod
+    def supports(api, capability):
+        """!
+        Check whether an attached device supports a capability.
+        @param api is an Airmusic API instance, passed to attach() before.
+        @param capability is the capability name, eg. 'FM', 'DAB' or 'BT'.
+        @return True if supported.
+        """
+        return bool(getattr(api, 'capabilities', dict()).get(capability))
+
+    def forget(self, api=None):
+        """!
+        Remove cached handshakes and probe results, eg. after the device was power cycled or a
+        probe result turned out to be wrong.
+        @param api is the Airmusic API instance to forget, together with the probe results of its
+               firmware version; None to forget all devices and firmware versions.
+        """
+        with self._lock:
+            if api is None:
+                self.cache['handshakes'].clear()
+                self.cache['firmware'].clear()
+            else:
+                cached = self.cache['handshakes'].pop(api.device_address, None)
+                if cached:
+                    self.cache['firmware'].pop(cached['result'].get('version') or 'unknown', None)
+            self._save()
@@ -0,0 +1,157 @@
+"""
+Volume fades for Airmusic based Internet Radios.
+
+set_volume() jumps straight to the requested volume level (0 .. 15). The fader class moves the
+volume one step at a time over a given duration:
+ - the steps are scheduled on a monotonic clock, spread evenly over the duration;
+ - if the device replies slower than the schedule, the intermediate steps that are overdue are
+   dropped and the level that is due now is sent instead, so a fade never runs late;
+ - a new fade cancels the running one, and starts from the last level the device confirmed;
+ - the vol tag returned by the setvol command confirms each level, and the final level is sent
+   again if the device did not reach it.
+
+Usage:
+  fader(am_obj).fade_to(10, duration=5)
+  fader(am_obj).fade_out_stop(duration=3)
+  fade_fleet([fader(am_kitchen), fader(am_bedroom)], 4, duration=10)
+"""
+import logging
+import threading
+import time
+
+
+class fader(object):
+    """
+    This class fades the volume of an Airmusic device.
+    """
+
+    def __init__(self, api):
+        """!
+        Constructor of the fader.
+        @param api is an Airmusic API instance.
+        """
+        self.api = api
+        self.logger = logging.getLogger("airmusic.fade")
+        # The last volume level confirmed by the device, None if not known yet.
+        self.level = None
+        # Number of commands sent to the device.
+        self.commands = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._cancel = None
+
+    def _set(self, level):
+        """!
+        @private
+        Send a volume level and note the level the device confirms.
+        """
+        self.commands += 1
+        resp = self.api.set_volume(level)
+        if isinstance(resp, dict) and 'vol' in resp:
+            self.level = int(resp['vol'])
+        else:
+            self.level = None
+        return self.level
+
+    def fade_to(self, level, duration, wait=True):
+        """!
+        Fade the volume to the given level.
+        A fade that is still running is cancelled; the new fade starts at the level reached.
+        @param level is the volume level to end with (0 .. 15).
+        @param duration is the number of seconds the fade takes.
+        @param wait is True to return when the fade has finished, False to fade in the background.
+        @return the final volume level confirmed by the device if wait is True, else None.
+        """
+        level = max(0, min(15, int(level)))
+        with self._lock:
+            if self._cancel is not None:
+                self._cancel.set()
+            cancel = self._cancel = threading.Event()
+            previous = self._thread
+            self._thread = threading.Thread(target=self._run, args=(level, duration, cancel, previous),
+                                            name='airmusic-fade')
+            self._thread.daemon = True
+            self._thread.start()
+        if wait:
+            return self.wait()
+        return None
+
+    def wait(self):
+        """!
+        Wait until the running fade has finished.
+        @return the final volume level confirmed by the device.
+        """
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+        return self.level
+
+    def _run(self, target, duration, cancel, previous):
+        """!
+        @private
+        Perform a fade. Runs in its own thread.
+        """
+        if previous is not None:
+            # The previous fade stops at its next step; never send two levels at the same time.
+            previous.join()
+        if cancel.is_set():
+            return
+        start = self.level
+        if start is None:
+            start = int(self.api.get_background_play_status()['vol'])
+        steps = abs(target - start)
+        sign = 1 if target > start else -1
+        begin = time.monotonic()
+        sent = start
+        while sent != target:
+            if cancel.is_set():
+                return
+            elapsed = time.monotonic() - begin
+            due = steps if duration <= 0 else min(steps, int(steps * elapsed / duration))
+            if start + sign * due != sent:
+                # Overdue intermediate steps are dropped: only the level due now is sent.
+                sent = start + sign * due
+                if self._set(sent) is None:
+                    self.logger.error("{}: no volume confirmation.".format(self.api.device_address))
+                    return
+                continue
+            next_step = begin + duration * (due + 1) / float(steps)
+            if cancel.wait(max(0, next_step - time.monotonic())):
+                return
+        if self.level != target and not cancel.is_set():
+            self._set(target)
+        if self.level != target:
+            self.logger.warning("{}: volume {} instead of {}.".format(self.api.device_address,
+                                                                     self.level, target))
+
+    def fade_out_stop(self, duration, restore=True):
+        """!
+        Fade the volume out and stop playing.
+        @param duration is the number of seconds the fade takes.
+        @param restore is True to set the original volume level again after stopping, so the next
+               song / station does not start silently.
+        @return the result of airmusic.stop().
+        """
+        self.wait()
+        original = self.level
+        if original is None:
+            original = int(self.api.get_background_play_status()['vol'])
+            self.level = original
+        self.fade_to(0, duration)
+        resp = self.api.stop()
+        if restore:
+            self._set(original)
+        return resp
+
+
+def fade_fleet(faders, level, duration):
+    """!
+    Fade several devices to the same level at the same time.
+    @param faders is a list of fader instances, one for each device.
+    @param level is the volume level to end with (0 .. 15).
+    @param duration is the number of seconds the fade takes.
+    @return a dict device address -> final volume level confirmed by the device.
+    """
+    for one in faders:
+        one.fade_to(level, duration, wait=False)
+    return dict((one.api.device_address, one.wait()) for one in faders)
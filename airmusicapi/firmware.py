@@ -0,0 +1,194 @@
+"""
+Firmware updates for a fleet of Airmusic based Internet Radios.
+
+The init() command reports SWUpdate=YES when a software update is available, and update_software()
+starts it. The firmwareupdater class does this for a list of devices:
+  (1) find the devices that report SWUpdate=YES and note their SW_Ver (get_systeminfo()),
+  (2) update them with at most batch_size devices at the same time; as soon as one device is done,
+      the next one is started, so never more than batch_size devices are offline,
+  (3) poll each updating device with an increasing interval until get_systeminfo() reports a new
+      SW_Ver, or until the deadline has passed.
+The progress is written to a JSON state file after each change. If the run is interrupted, the next
+run with the same state file skips the devices that are done and continues polling the devices that
+were updating, without starting their update again.
+
+Usage:
+  updater = firmwareupdater(['192.168.2.147', '192.168.2.148'], 'firmware-state.json')
+  print(updater.run())
+"""
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from xml.parsers.expat import ExpatError
+import requests
+from airmusicapi import airmusic
+
+
+# States of a device in the state file.
+PENDING = 'pending'
+UPDATING = 'updating'
+DONE = 'done'
+FAILED = 'failed'
+UP_TO_DATE = 'up-to-date'
+
+# Replies of update_software() that indicate the update has been accepted.
+UPDATE_ACCEPTED = ('PROCESSING', 'OK')
+
+
+class _updateapi(airmusic):
+    """!
+    @private
+    Airmusic API instance used for updating only.
+    An update must not stop the music, nor send commands to a device while it is flashing: unlike
+    airmusic, nothing is sent when the instance is deleted.
+    """
+
+    def __del__(self):
+        pass
+
+
+class firmwareupdater(object):
+    """
+    This class updates the firmware of several devices in rolling batches.
+    """
+
+    def __init__(self, addresses, state_file, batch_size=5, timeout=5,
+                 poll_min=5, poll_max=60, deadline=1800):
+        """!
+        Constructor of the firmware updater.
+        @param addresses is a list of device IP-addresses or resolvable names.
+        @param state_file is the name of the JSON file holding the progress of the run.
+        @param batch_size is the maximum number of devices updating at the same time.
+        @param timeout determines the maximum amount of seconds to wait for a reply from a device.
+        @param poll_min is the first interval (seconds) between two progress polls.
+        @param poll_max is the longest interval (seconds) between two progress polls.
+        @param deadline is the maximum amount of seconds an update of a single device may take.
+        """
+        self.addresses = list(addresses)
+        self.state_file = state_file
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.deadline = deadline
+        self.logger = logging.getLogger("airmusic.firmware")
+        self._lock = threading.Lock()
+        self.devices = dict()
+        if os.path.exists(state_file):
+            with open(state_file) as handle:
+                self.devices = json.load(handle)
+
+    def _save(self, address, **values):
+        """!
+        @private
+        Update the state of a device and write the state file.
+        The file is replaced in one step, so an interrupted run never leaves a broken file.
+        """
+        with self._lock:
+            self.devices.setdefault(address, dict()).update(values)
+            temp_file = self.state_file + '.tmp'
+            with open(temp_file, 'w') as handle:
+                json.dump(self.devices, handle, indent=2, sort_keys=True)
+            os.replace(temp_file, self.state_file)
+
+    def _version(self, api):
+        """!
+        @private
+        Return the firmware version of a device, or None if it does not respond.
+        """
+        try:
+            return api.get_systeminfo()['SW_Ver']
+        except (requests.RequestException, ExpatError, KeyError, TypeError):
+            return None
+
+    def discover(self):
+        """!
+        Find the devices that have a software update available.
+        Devices that are done or were found up-to-date in an earlier run are not queried again.
+        @return a list of addresses of the devices to update.
+        """
+        def check(address):
+            state = self.devices.get(address, dict()).get('state')
+            if state in (DONE, UP_TO_DATE):
+                return None
+            if state == UPDATING:
+                return address
+            api = _updateapi(address, self.timeout)
+            try:
+                update = api.init()['SWUpdate']
+            except (requests.RequestException, ExpatError, KeyError, TypeError) as err:
+                self.logger.error("{}: not reachable: {}".format(address, err))
+                return None
+            if update != 'YES':
+                self._save(address, state=UP_TO_DATE, version=self._version(api))
+                return None
+            old_version = self._version(api)
+            if old_version is None:
+                # Without the current version, the new version cannot be recognised.
+                self.logger.error("{}: firmware version unknown, not updated.".format(address))
+                self._save(address, state=FAILED, error='version unknown')
+                return None
+            self._save(address, state=PENDING, old_version=old_version)
+            return address
+
+        with ThreadPoolExecutor(max_workers=max(1, self.batch_size * 2)) as pool:
+            return [address for address in pool.map(check, self.addresses) if address]
+
+    def update(self, address):
+        """!
+        Update a single device and wait until it reports a new firmware version.
+        If the state file shows the update was started in an earlier run, it is not started again.
+        @param address is the device IP-address or resolvable name.
+        @return the new state of the device, DONE or FAILED.
+        """
+        api = _updateapi(address, self.timeout)
+        device = self.devices.get(address, dict())
+        old_version = device.get('old_version')
+        if device.get('state') != UPDATING:
+            # Read the version again right before starting; it must be known to verify the update.
+            old_version = self._version(api) or old_version
+            if old_version is None:
+                self.logger.error("{}: firmware version unknown, not updated.".format(address))
+                self._save(address, state=FAILED, error='version unknown')
+                return FAILED
+            self._save(address, old_version=old_version)
+            try:
+                status = api.update_software()
+            except (requests.RequestException, ExpatError, KeyError, TypeError) as err:
+                self.logger.error("{}: update not started: {}".format(address, err))
+                self._save(address, state=FAILED, error=str(err))
+                return FAILED
+            if status not in UPDATE_ACCEPTED:
+                self.logger.error("{}: update refused: {}".format(address, status))
+                self._save(address, state=FAILED, error='refused: {}'.format(status))
+                return FAILED
+            self.logger.info("{}: update started: {}".format(address, status))
+            self._save(address, state=UPDATING, started=time.time())
+        started = self.devices[address].get('started', time.time())
+        interval = self.poll_min
+        while time.time() - started < self.deadline:
+            version = self._version(api)
+            if version is not None and version != old_version:
+                self.logger.info("{}: updated from {} to {}".format(address, old_version, version))
+                self._save(address, state=DONE, version=version, finished=time.time())
+                return DONE
+            # The device is still updating, or rebooting and not responding.
+            time.sleep(interval)
+            interval = min(self.poll_max, interval * 2)
+        self.logger.error("{}: no new version after {} seconds.".format(address, self.deadline))
+        self._save(address, state=FAILED, error='timeout')
+        return FAILED
+
+    def run(self):
+        """!
+        Find and update all devices that have a software update available.
+        @return a dict address -> state for all devices of this run.
+        """
+        todo = self.discover()
+        self.logger.info("{} of {} devices to update.".format(len(todo), len(self.addresses)))
+        with ThreadPoolExecutor(max_workers=self.batch_size) as pool:
+            list(pool.map(self.update, todo))
+        return dict((address, self.devices.get(address, dict()).get('state')) for address in self.addresses)
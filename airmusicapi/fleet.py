@@ -0,0 +1,443 @@
+"""
+Polling a large fleet of Airmusic based Internet Radios.
+
+One Python process cannot poll and parse the replies of thousands of devices every second. The
+fleetpoller class divides the devices over a number of worker processes. Each worker polls its
+devices with get_playinfo() and writes the latest status of each device into a status table.
+
+The status table is a file with a fixed layout: a header followed by one slot of fixed size per
+device. It is memory mapped by the workers and by any reader, eg. a web server, so the fleet status
+can be read without asking the poller. Each slot holds a sequence number that is odd while the slot
+is being written; readers retry until they read a slot with the same even number before and after,
+and give up after READ_RETRIES attempts, eg. when a worker died while writing.
+Only one process writes a slot at a time: a slot is handed to another worker, or to another device,
+only after its worker has confirmed that it released the slot.
+
+Usage (poller):
+  poller = fleetpoller(addresses, '/run/airmusic/fleet.tbl', processes=4)
+  poller.start()
+  poller.add('192.168.2.150')
+  poller.remove('192.168.2.147')
+
+Usage (reader, in any process):
+  table = fleettable('/run/airmusic/fleet.tbl')
+  for status in table.read_all():
+      print(status['address'], status['online'], status['vol'], status['station'])
+"""
+import logging
+import mmap
+import multiprocessing
+import queue
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from airmusicapi import airmusic
+
+
+MAGIC = b'AMFT'
+LAYOUT_VERSION = 1
+HEADER = struct.Struct('<4sII')  # magic, layout version, number of slots
+# seq, updated, in_use, online, sid, vol, mute, errors, address, status, station, artist, song
+SLOT = struct.Struct('<IdBBBBBxxxI64s32s64s64s64s')
+TEXT_FIELDS = ('address', 'status', 'station', 'artist', 'song')
+# Number of times a reader tries to read a slot that is being written.
+READ_RETRIES = 100
+
+
+def _text(value, size):
+    """!
+    @private
+    Encode a string for a fixed size field, without cutting a character in half.
+    """
+    data = str(value or '').strip().encode('utf-8')[:size]
+    return data.decode('utf-8', 'ignore').encode('utf-8')
+
+
+class fleettable(object):
+    """
+    This class gives access to the memory mapped status table of a fleet.
+    """
+
+    def __init__(self, path, slots=None):
+        """!
+        Open a status table, or create it if the number of slots is given.
+        @param path is the name of the table file.
+        @param slots is the number of slots to create the table with, None to open an existing table.
+        """
+        self.path = path
+        if slots is not None:
+            with open(path, 'wb') as handle:
+                handle.write(HEADER.pack(MAGIC, LAYOUT_VERSION, slots))
+                handle.truncate(HEADER.size + SLOT.size * slots)
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, version, self.slots = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != LAYOUT_VERSION:
+            raise ValueError("{} is not a fleet status table.".format(path))
+
+    def close(self):
+        """!
+        Unmap and close the table.
+        """
+        self._map.close()
+        self._file.close()
+
+    def _offset(self, slot):
+        """!
+        @private
+        Return the position of a slot in the table.
+        """
+        if not 0 <= slot < self.slots:
+            raise IndexError("Slot {} outside the table.".format(slot))
+        return HEADER.size + SLOT.size * slot
+
+    def write(self, slot, address, playinfo=None, errors=0):
+        """!
+        Write the status of a device into its slot.
+        Only one process may write a given slot at a time.
+        @param slot is the slot number of the device.
+        @param address is the address of the device.
+        @param playinfo is the dict returned by get_playinfo(), None if the device did not respond.
+        @param errors is the number of failed polls in a row.
+        """
+        offset = self._offset(slot)
+        info = playinfo or dict()
+        status = info.get('status') or info.get('result')
+        if isinstance(status, dict):
+            # get_playinfo() returns the error reply, eg. {'rt': 'INVALID_CMD'}, in the result tag.
+            status = status.get('rt') or str(status)
+        # Everything is converted before the slot is touched, so a bad value cannot leave it locked.
+        fields = (time.time(), 1, 1 if playinfo is not None else 0,
+                  int(info.get('sid') or 0) & 0xFF, int(info.get('vol') or 0) & 0xFF,
+                  1 if info.get('mute') == '1' else 0, errors,
+                  _text(address, 64), _text(status, 32), _text(info.get('station_info'), 64),
+                  _text(info.get('artist'), 64), _text(info.get('song'), 64))
+        seq = struct.unpack_from('<I', self._map, offset)[0]
+        # An odd sequence number tells readers the slot is being written.
+        struct.pack_into('<I', self._map, offset, (seq + 1) | 1)
+        SLOT.pack_into(self._map, offset, (seq + 1) | 1, *fields)
+        struct.pack_into('<I', self._map, offset, ((seq + 1) | 1) + 1)
+
+    def clear(self, slot):
+        """!
+        Mark a slot as free.
+        @param slot is the slot number.
+        """
+        offset = self._offset(slot)
+        seq = struct.unpack_from('<I', self._map, offset)[0]
+        struct.pack_into('<I', self._map, offset, (seq + 1) | 1)
+        self._map[offset + 4:offset + SLOT.size] = bytes(SLOT.size - 4)
+        struct.pack_into('<I', self._map, offset, ((seq + 1) | 1) + 1)
+
+    def read(self, slot):
+        """!
+        Read the status of a slot.
+        Returned are the tags address, updated (seconds since the epoch), online, sid, vol, mute,
+        errors, status, station, artist and song.
+        @param slot is the slot number.
+        @return a dict holding the status, or None if the slot is free or could not be read.
+        """
+        offset = self._offset(slot)
+        for _ in range(READ_RETRIES):
+            values = SLOT.unpack_from(self._map, offset)
+            if not values[0] & 1 and struct.unpack_from('<I', self._map, offset)[0] == values[0]:
+                break
+            time.sleep(0)  # The slot is being written; let the writer finish.
+        else:
+            return None
+        if not values[2]:
+            return None
+        status = dict(updated=values[1], online=bool(values[3]), sid=values[4], vol=values[5],
+                      mute=bool(values[6]), errors=values[7])
+        for name, value in zip(TEXT_FIELDS, values[8:]):
+            status[name] = value.rstrip(b'\0').decode('utf-8', 'ignore')
+        return status
+
+    def read_all(self):
+        """!
+        Read the status of all devices in the table.
+        @return a list of status dicts (see read()), each with the additional tag slot.
+        """
+        result = []
+        for slot in range(self.slots):
+            status = self.read(slot)
+            if status is not None:
+                status['slot'] = slot
+                result.append(status)
+        return result
+
+
+class _pollapi(airmusic):
+    """!
+    @private
+    Airmusic API instance used for polling only.
+    Polling must not stop the music: unlike airmusic, nothing is sent when the instance is deleted.
+    """
+
+    def __del__(self):
+        pass
+
+
+def _worker(path, control, released, interval, timeout, threads):
+    """!
+    @private
+    Main loop of a worker process: poll the devices of this shard and write the status table.
+    The control queue holds ('add', slot, address) and ('release', slot, None) messages; None stops
+    the worker. A released slot is confirmed on the released queue once it is no longer written.
+    """
+    table = fleettable(path)
+    devices = dict()  # slot -> [api, errors]
+    pool = ThreadPoolExecutor(max_workers=threads)
+
+    def poll(slot):
+        device = devices.get(slot)
+        if device is None:
+            return
+        try:
+            info = device[0].get_playinfo()
+            device[1] = 0
+        except Exception:  # Any failure means the device is offline at the moment.
+            info = None
+            device[1] += 1
+        if slot in devices:
+            try:
+                table.write(slot, device[0].device_address, info, device[1])
+            except Exception as err:  # A reply that cannot be stored must not stop the worker.
+                logging.getLogger("airmusic.fleet").error("{}: {}".format(device[0].device_address, err))
+
+    deadline = time.monotonic()
+    while True:
+        try:
+            message = control.get(timeout=max(0, deadline - time.monotonic()))
+        except queue.Empty:
+            message = ()
+        if message is None:
+            break
+        if message:
+            action, slot, address = message
+            if action == 'add':
+                devices[slot] = [_pollapi(address, timeout), 0]
+            else:
+                devices.pop(slot, None)
+                released.put(slot)
+            continue
+        deadline = time.monotonic() + interval
+        list(pool.map(poll, list(devices)))
+    pool.shutdown()
+    table.close()
+
+
+class fleetpoller(object):
+    """
+    This class polls a fleet of devices with several worker processes.
+    """
+
+    def __init__(self, addresses, path, processes=None, capacity=None, interval=1.0, timeout=2,
+                 threads=32):
+        """!
+        Constructor of the fleet poller.
+        @param addresses is a list of device IP-addresses or resolvable names.
+        @param path is the name of the status table file. It is created (or overwritten) by start().
+        @param processes is the number of worker processes. Default is the number of CPUs.
+        @param capacity is the number of slots in the status table. Default is twice the number of
+               addresses, with a minimum of 64.
+        @param interval is the number of seconds between two polls of a device.
+        @param timeout determines the maximum amount of seconds to wait for a reply from a device.
+        @param threads is the number of devices a worker polls at the same time.
+        """
+        self.addresses = list(addresses)
+        self.path = path
+        self.processes = processes or multiprocessing.cpu_count()
+        self.capacity = capacity or max(64, 2 * len(self.addresses))
+        self.interval = interval
+        self.timeout = timeout
+        self.threads = threads
+        self.logger = logging.getLogger("airmusic.fleet")
+        self.table = None
+        self.slots = dict()  # address -> slot
+        self.shards = dict()  # address -> worker number
+        self._workers = []  # (process, control queue)
+        self._released = None  # queue on which the workers confirm released slots
+        self._busy = dict()  # slot -> worker number, for slots released but not confirmed yet
+        self._moves = dict()  # slot -> (address, worker number) to hand the slot to once confirmed
+
+    def _spawn(self):
+        """!
+        @private
+        Start a worker process and return (process, control queue).
+        """
+        control = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_worker, name='airmusic-fleet',
+                                          args=(self.path, control, self._released, self.interval,
+                                                self.timeout, self.threads))
+        process.daemon = True
+        process.start()
+        return process, control
+
+    def start(self):
+        """!
+        Create the status table, start the workers and divide the devices over them.
+        """
+        self.table = fleettable(self.path, self.capacity)
+        self._released = multiprocessing.Queue()
+        self._workers = [self._spawn() for _ in range(self.processes)]
+        for address in self.addresses:
+            self.add(address)
+
+    def _load(self):
+        """!
+        @private
+        Return the number of devices per worker.
+        """
+        load = [0] * len(self._workers)
+        for worker in self.shards.values():
+            load[worker] += 1
+        return load
+
+    def _release(self, worker, slot):
+        """!
+        @private
+        Ask a worker to stop writing a slot. The slot is not used again until the worker confirmed.
+        """
+        self._busy[slot] = worker
+        self._workers[worker][1].put(('release', slot, None))
+
+    def _released_slot(self, slot):
+        """!
+        @private
+        Handle a slot that is no longer written: hand it to the worker it moves to, or clear it.
+        """
+        self._busy.pop(slot, None)
+        move = self._moves.pop(slot, None)
+        if move is not None and self.slots.get(move[0]) == slot:
+            self._workers[move[1]][1].put(('add', slot, move[0]))
+        elif slot not in self.slots.values():
+            self.table.clear(slot)
+
+    def _confirm(self, wait=0):
+        """!
+        @private
+        Handle the slots the workers confirmed as released.
+        @param wait is the maximum number of seconds to wait until all released slots are confirmed.
+        """
+        deadline = time.monotonic() + wait
+        while self._busy:
+            try:
+                slot = self._released.get(True, max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                return
+            if slot in self._busy:  # Else it was handled already, eg. its worker died.
+                self._released_slot(slot)
+
+    def _free(self):
+        """!
+        @private
+        Return the slots that are neither used nor waiting for a confirmation.
+        """
+        used = set(self.slots.values())
+        return [slot for slot in range(self.capacity) if slot not in used and slot not in self._busy]
+
+    def add(self, address):
+        """!
+        Start polling a device, on the worker with the fewest devices.
+        @param address is the device IP-address or resolvable name.
+        @return the slot of the device in the status table.
+        """
+        if address in self.slots:
+            return self.slots[address]
+        self._confirm()
+        free = self._free()
+        if not free and self._busy:
+            # A worker handles its queue between two polls.
+            self._confirm(self.timeout + self.interval + 1)
+            free = self._free()
+        if not free:
+            raise IndexError("The status table is full ({} slots).".format(self.capacity))
+        load = self._load()
+        worker = load.index(min(load))
+        self.slots[address] = free[0]
+        self.shards[address] = worker
+        if address not in self.addresses:
+            self.addresses.append(address)
+        self._workers[worker][1].put(('add', free[0], address))
+        return free[0]
+
+    def remove(self, address):
+        """!
+        Stop polling a device and free its slot. The shards are rebalanced afterwards.
+        The slot is cleared once the worker confirmed it no longer writes it.
+        @param address is the device IP-address or resolvable name.
+        """
+        if address not in self.slots:
+            return
+        slot = self.slots.pop(address)
+        worker = self.shards.pop(address)
+        self.addresses.remove(address)
+        if self._moves.pop(slot, None) is None:
+            self._release(worker, slot)
+        # Else the slot is still being released by the worker it was moving away from.
+        self.rebalance()
+
+    def rebalance(self):
+        """!
+        Move devices from the busiest workers to the least busy ones, until the number of devices
+        per worker differs at most one.
+        A device is handed to its new worker only after the old worker released its slot; this
+        waits at most for one poll round.
+        @return the number of devices moved.
+        """
+        moved = 0
+        while True:
+            load = self._load()
+            busiest = load.index(max(load))
+            idlest = load.index(min(load))
+            if load[busiest] - load[idlest] <= 1:
+                break
+            address = next(a for a, worker in self.shards.items()
+                           if worker == busiest and self.slots[a] not in self._moves)
+            slot = self.slots[address]
+            self._release(busiest, slot)
+            self._moves[slot] = (address, idlest)
+            self.shards[address] = idlest
+            moved += 1
+        self._confirm(self.timeout + self.interval + 1 if moved else 0)
+        return moved
+
+    def check(self):
+        """!
+        Replace worker processes that have died, handing their devices to the new process.
+        Call this regularly from the main program.
+        @return the number of workers replaced.
+        """
+        replaced = 0
+        for number, (process, _) in enumerate(self._workers):
+            if process.is_alive():
+                continue
+            self.logger.error("Fleet worker {} died (exit code {}), restarting.".format(number,
+                                                                                     process.exitcode))
+            self._workers[number] = self._spawn()
+            for address, worker in self.shards.items():
+                if worker == number and self.slots[address] not in self._moves:
+                    self._workers[number][1].put(('add', self.slots[address], address))
+            # A dead worker no longer writes the slots it was asked to release.
+            for slot, worker in list(self._busy.items()):
+                if worker == number:
+                    self._released_slot(slot)
+            replaced += 1
+        self._confirm()
+        return replaced
+
+    def stop(self):
+        """!
+        Stop all worker processes.
+        """
+        for _, control in self._workers:
+            control.put(None)
+        for process, _ in self._workers:
+            process.join(self.timeout + self.interval + 1)
+            if process.is_alive():
+                process.terminate()
+        self._workers = []
+        if self.table:
+            self.table.close()
+            self.table = None
@@ -0,0 +1,215 @@
+"""
+FM band scanner for Airmusic based Internet Radios.
+
+The device can search for the next FM station with the SetFMManualsearch command. While
+searching, the tag 'Search' of GetFMStatus is TRUE. Once a station is found it turns FALSE and
+the tags Freq, Signal, Sound and RDS describe the station found.
+The scanner repeats these steps until it has swept the complete band, and turns the stops into a
+ranked station table.
+
+Usage (the device must be in FM mode):
+  scanner = fmscanner(am_obj)
+  stations = scanner.scan()
+  for station in scanner.rank(stations):
+      print("{rank:2} {Freq:6.2f} {Signal:3} {Sound} {RDS}".format(**station))
+"""
+import logging
+import time
+
+
+class fmscanner(object):
+    """
+    This class sweeps the FM band of an Airmusic device and builds a station table.
+    """
+
+    def __init__(self, api, poll_min=0.05, poll_max=0.5, step_timeout=10):
+        """!
+        Constructor of the FM scanner.
+        @param api is an Airmusic API instance, see airmusic.
+        @param poll_min is the shortest time (seconds) between two status polls, used while searching.
+        @param poll_max is the longest time (seconds) between two status polls, used while waiting
+               for the search to start.
+        @param step_timeout is the maximum amount of seconds to wait for a single search step.
+        """
+        self.api = api
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.step_timeout = step_timeout
+        self.logger = logging.getLogger("airmusic.fmscan")
+        # Learned average duration of a search step, used to delay the first poll of the next step.
+        self.search_time = None
+        # Number of commands sent to the device.
+        self.commands = 0
+
+    def status(self):
+        """!
+        Fetch the FM status and convert the numeric tags.
+        @return the FM status with Freq as float and Signal as int, or None if not in FM mode.
+        """
+        self.commands += 1
+        resp = self.api.get_FM_status()
+        if not isinstance(resp, dict) or 'Freq' not in resp:
+            return None
+        status = dict(resp)
+        status['Freq'] = round(float(status['Freq']), 2)
+        status['Signal'] = int(status.get('Signal') or 0)
+        return status
+
+    def step(self, direction, previous):
+        """!
+        Search the next station in the given direction and wait until the search has finished.
+        The first poll is delayed by the learned search duration. While the 'Search' tag is TRUE
+        the status is polled at the fastest rate; while the search has not started yet the poll
+        interval is doubled up to poll_max.
+        @param direction is the direction to search for the next station, 'down' or 'up'.
+        @param previous is the FM status before the search (as returned by status()).
+        @return the FM status at the station found, or None if the search did not finish in time.
+        """
+        start = time.monotonic()
+        self.commands += 1
+        rt = self.api.set_FM_manualsearch(direction)
+        if rt != 'OK':
+            self.logger.error("FM search failed: {}".format(rt))
+            return None
+        delay = self.search_time * 0.8 if self.search_time else self.poll_min
+        searching = False
+        while time.monotonic() - start < self.step_timeout:
+            time.sleep(delay)
+            status = self.status()
+            if status is None:
+                return None
+            if status.get('Search') == 'TRUE':
+                searching = True
+                delay = self.poll_min
+            elif searching or status['Freq'] != previous['Freq']:
+                elapsed = time.monotonic() - start
+                if self.search_time is None:
+                    self.search_time = elapsed
+                else:
+                    self.search_time = 0.7 * self.search_time + 0.3 * elapsed
+                return status
+            else:
+                delay = min(delay * 2, self.poll_max)
+        self.logger.warning("FM search did not finish within {} seconds.".format(self.step_timeout))
+        return None
+
+    def scan(self, direction='up', max_stations=100):
+        """!
+        Sweep the complete FM band.
+        The sweep starts at the current frequency and stops when a station is found for the second
+        time, or when the search wrapped around the end of the band and passed the start frequency.
+        Each station in the result holds the tags:
+         - Freq : the frequency (float), eg. 87.5
+         - Signal : the signal reception level (int)
+         - Sound : MONO or STEREO
+         - RDS : the RDS info, if available
+        @param direction is the sweep direction, 'down' or 'up'.
+        @param max_stations is the maximum number of stations to find.
+        @return a list of stations, in the order they were found; empty if not in FM mode.
+        """
+        if direction not in ('up', 'down'):
+            self.logger.error("Error: direction must be 'down' or 'up'.")
+            return []
+        sign = 1 if direction == 'up' else -1
+        status = self.status()
+        if status is None:
+            self.logger.error("The device is not in FM mode.")
+            return []
+        start_freq = status['Freq']
+        wrapped = False
+        found = dict()
+        stations = []
+        while len(stations) < max_stations:
+            previous = status
+            status = self.step(direction, previous)
+            if status is None:
+                break
+            freq = status['Freq']
+            if sign * (freq - previous['Freq']) < 0:
+                wrapped = True
+            if freq in found or (wrapped and sign * (freq - start_freq) > 0):
+                break
+            station = dict(Freq=freq, Signal=status['Signal'], Sound=status.get('Sound'),
+                           RDS=status.get('RDS'))
+            found[freq] = station
+            stations.append(station)
+            self.logger.debug("Found FM station {:.2f} signal {}".format(freq, station['Signal']))
+        return stations
+
+    @staticmethod
+    def rank(stations):
+        """!
+        Rank the stations found by reception quality.
+        Stations with a stronger signal rank higher. For equal signal levels, STEREO reception
+        and available RDS info rank higher.
+        @param stations is the list of stations, as returned by scan().
+        @return a new list of stations, best first, each with the additional tag rank (1 = best).
+        """
+        ranked = sorted(stations, key=lambda s: (-s['Signal'], s.get('Sound') != 'STEREO',
+                                                 not s.get('RDS'), s['Freq']))
+        return [dict(station, rank=nr) for nr, station in enumerate(ranked, 1)]
+
+    def tune(self, freq, band):
+        """!
+        Tune to a station found earlier, using the shortest number of search steps.
+        There is no command to select an FM frequency directly. Instead the number of stations
+        between the current frequency and the requested one is taken from the band, and the
+        search is repeated in the direction with the fewest steps.
+        @param freq is the frequency (float) of the station to tune to.
+        @param band is the list of stations found by scan().
+        @return the FM status at the requested station, or None on failure.
+        """
+        status = self.status()
+        if status is None:
+            return None
+        freqs = sorted(station['Freq'] for station in band)
+        if freq not in freqs:
+            return None
+        if status['Freq'] == freq:
+            return status
+        target = freqs.index(freq)
+        above = [nr for nr, f in enumerate(freqs) if f > status['Freq']]
+        current = above[0] if above else len(freqs)
+        up_steps = (target - current) % len(freqs) + 1
+        down_steps = len(freqs) - up_steps + (0 if status['Freq'] in freqs else 1)
+        direction = 'up' if up_steps <= down_steps else 'down'
+        for _ in range(len(freqs) + 1):
+            status = self.step(direction, status)
+            if status is None or status['Freq'] == freq:
+                return status
+        return None
+
+    def populate_favourites(self, stations, store, count=5):
+        """!
+        Store the best stations as FM favourites.
+        The device offers no command to write an FM favourite, and models differ in the keys
+        needed to do so. Therefore the scanner tunes to each station and calls the given store
+        function, which performs the model specific steps (eg. a sequence of send_rc_key() calls).
+        Afterwards the FM favourites list is fetched to verify the result.
+        @param stations is the ranked list of stations, as returned by rank().
+        @param store is a function store(pos, station) called while tuned to the station.
+        @param count is the number of favourites to store.
+        @return a list of dicts with the tags pos, Freq and ok.
+        """
+        report = []
+        for pos, station in enumerate(stations[:count], 1):
+            if self.tune(station['Freq'], stations) is None:
+                report.append(dict(pos=pos, Freq=station['Freq'], ok=False))
+                continue
+            store(pos, station)
+            report.append(dict(pos=pos, Freq=station['Freq'], ok=None))
+        self.commands += 1
+        favourites = self.api.get_FM_favourites()
+        items = favourites.get('item', []) if isinstance(favourites, dict) else []
+        if isinstance(items, dict):
+            items = [items]
+        stored = set()
+        for item in items:
+            try:
+                stored.add(round(float(item['Freq']), 2))
+            except (KeyError, TypeError, ValueError):
+                continue
+        for entry in report:
+            if entry['ok'] is None:
+                entry['ok'] = entry['Freq'] in stored
+        return report
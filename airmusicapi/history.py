@@ -0,0 +1,317 @@
+"""
+Compact listening history for Airmusic based Internet Radios.
+
+The recorder receives the result of get_playinfo() of one or more devices and stores an event each
+time the station, artist, song, sid or volume changes. The events are kept in a columnar, append-only
+store on disk: one file per column, holding fixed size numbers. Strings (device names, stations,
+artists and songs) are interned once in a string table and stored as numbers in the columns.
+
+Files in the history directory:
+ - strings.txt : the interned strings, one per line. The line number is the string number.
+ - time.u32 : the start time of each event (seconds since the epoch).
+ - dur.u32 : the number of seconds the state lasted, filled in at the next event of the device.
+ - device.u32, station.u32, artist.u32, song.u32 : the interned strings of each event.
+ - sid.u8, vol.u8 : the play status (see airmusic.SID) and volume level of each event.
+
+The column files are memory mapped for queries. If numpy is installed, the aggregations run on the
+mapped columns without copying; otherwise a pure Python implementation is used.
+
+Usage:
+  history = playhistory('history')
+  history.record('kitchen', am_obj.get_playinfo())
+  print(history.time_per('station', start=time.time() - 86400))
+"""
+import array
+import bisect
+import logging
+import mmap
+import os
+import threading
+import time
+from collections import defaultdict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Column name -> array typecode. The typecodes have the same size on all common platforms.
+COLUMNS = (('time', 'I'), ('dur', 'I'), ('device', 'I'), ('station', 'I'), ('artist', 'I'),
+           ('song', 'I'), ('sid', 'B'), ('vol', 'B'))
+
+# Duration of an event that has not been followed by another event of the same device yet.
+OPEN = 0xFFFFFFFF
+
+SID_BUFFERING = 2
+SID_FAILED = 14
+
+
+class playhistory(object):
+    """
+    This class records playinfo changes of Airmusic devices and answers queries over time ranges.
+    """
+
+    def __init__(self, path):
+        """!
+        Open or create a listening history.
+        @param path is the directory holding the history files.
+        """
+        self.path = path
+        self.logger = logging.getLogger("airmusic.history")
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._strings = ['']
+        self._string_ids = {'': 0}
+        strings_file = os.path.join(path, 'strings.txt')
+        if os.path.exists(strings_file):
+            with open(strings_file, encoding='utf-8') as handle:
+                for line in handle:
+                    self._string_ids[line[:-1]] = len(self._strings)
+                    self._strings.append(line[:-1])
+        self._strings_file = open(strings_file, 'a', encoding='utf-8')
+        self._files = dict()
+        for name, typecode in COLUMNS:
+            self._files[name] = open(self._column_file(name, typecode), 'ab')
+        self._dur_file = open(self._column_file('dur', 'I'), 'r+b')
+        self.count = os.path.getsize(self._column_file('time', 'I')) // array.array('I').itemsize
+        # Per device: (index of the last event, its start time, its state tuple).
+        self._last = dict()
+        times = self._column('time')
+        durs = self._column('dur')
+        devices = self._column('device')
+        if numpy is not None and self.count:
+            open_events = numpy.nonzero(durs == OPEN)[0]
+        else:
+            open_events = [index for index in range(self.count) if durs[index] == OPEN]
+        for index in open_events:
+            index = int(index)
+            self._last[int(devices[index])] = (index, int(times[index]), None)
+        self._last_time = int(times[self.count - 1]) if self.count else 0
+
+    def _column_file(self, name, typecode):
+        """!
+        @private
+        Return the file name of a column.
+        """
+        size = array.array(typecode).itemsize
+        return os.path.join(self.path, '{}.{}{}'.format(name, 'u', size * 8))
+
+    def _intern(self, text):
+        """!
+        @private
+        Return the number of the given string, adding it to the string table if needed.
+        """
+        text = ' '.join(str(text).splitlines()) if text else ''
+        number = self._string_ids.get(text)
+        if number is None:
+            number = self._string_ids[text] = len(self._strings)
+            self._strings.append(text)
+            self._strings_file.write(text + '\n')
+        return number
+
+    def record(self, device, playinfo, timestamp=None):
+        """!
+        Record the playinfo of a device, if it differs from the previous one.
+        @param device is the name of the device, eg. its friendly name or IP-address.
+        @param playinfo is the dict returned by airmusic.get_playinfo().
+        @param timestamp is the time of the sample in seconds since the epoch. Default is now.
+        @return True if an event was stored, False if nothing changed.
+        """
+        now = int(time.time() if timestamp is None else timestamp)
+        with self._lock:
+            dev = self._intern(device)
+            state = (self._intern((playinfo.get('station_info') or '').strip()),
+                     self._intern((playinfo.get('artist') or '').strip()),
+                     self._intern((playinfo.get('song') or '').strip()),
+                     int(playinfo.get('sid') or 0) & 0xFF,
+                     int(playinfo.get('vol') or 0) & 0xFF)
+            # Events are kept in time order; a late sample is recorded at the last event time.
+            now = max(now, self._last_time)
+            last = self._last.get(dev)
+            if last is not None:
+                if last[2] is None:
+                    last = self._last[dev] = (last[0], last[1], self._state(last[0]))
+                if last[2] == state:
+                    return False
+                self._files['dur'].flush()
+                self._dur_file.seek(last[0] * array.array('I').itemsize)
+                self._dur_file.write(array.array('I', [now - last[1]]).tobytes())
+            values = dict(time=now, dur=OPEN, device=dev, station=state[0], artist=state[1],
+                          song=state[2], sid=state[3], vol=state[4])
+            for name, typecode in COLUMNS:
+                self._files[name].write(array.array(typecode, [values[name]]).tobytes())
+            self._last[dev] = (self.count, now, state)
+            self._last_time = now
+            self.count += 1
+            return True
+
+    def _state(self, index):
+        """!
+        @private
+        Read the state tuple of a stored event.
+        """
+        self.flush()
+        return tuple(int(self._column(name)[index]) for name in ('station', 'artist', 'song', 'sid', 'vol'))
+
+    def flush(self):
+        """!
+        Write all buffered events to disk.
+        """
+        self._strings_file.flush()
+        for handle in self._files.values():
+            handle.flush()
+        self._dur_file.flush()
+
+    def close(self):
+        """!
+        Flush and close the history files.
+        """
+        self.flush()
+        self._strings_file.close()
+        for handle in self._files.values():
+            handle.close()
+        self._dur_file.close()
+
+    def _column(self, name):
+        """!
+        @private
+        Map a column file into memory and return it as a typed memoryview (or numpy array).
+        """
+        typecode = dict(COLUMNS)[name]
+        with open(self._column_file(name, typecode), 'rb') as handle:
+            size = array.array(typecode).itemsize * self.count
+            if size == 0:
+                return array.array(typecode)
+            mapped = mmap.mmap(handle.fileno(), size, access=mmap.ACCESS_READ)
+        if numpy is not None:
+            return numpy.frombuffer(mapped, dtype=numpy.dtype(typecode))
+        return memoryview(mapped).cast(typecode)
+
+    def _select(self, start, end, device):
+        """!
+        @private
+        Return the index range of the events starting in [start, end), the columns needed
+        for the durations and an optional device filter.
+        """
+        self.flush()
+        times = self._column('time')
+        search = numpy.searchsorted if numpy is not None else bisect.bisect_left
+        lo = int(search(times, int(start))) if start else 0
+        hi = int(search(times, int(end))) if end is not None else self.count
+        dev = self._string_ids.get(device) if device is not None else None
+        return lo, hi, times, dev
+
+    def _durations(self, lo, hi, times, end):
+        """!
+        @private
+        Return the seconds of each event in [lo, hi), cut off at end (or now for open events).
+        """
+        limit = int(time.time() if end is None else end)
+        durs = self._column('dur')
+        if numpy is not None:
+            start = times[lo:hi].astype(numpy.int64)
+            dur = durs[lo:hi].astype(numpy.int64)
+            stop = numpy.where(dur == OPEN, limit, start + dur)
+            return numpy.clip(numpy.minimum(stop, limit) - start, 0, None)
+        return [max(0, min(limit if durs[i] == OPEN else times[i] + durs[i], limit) - times[i])
+                for i in range(lo, hi)]
+
+    def time_per(self, column, start=None, end=None, device=None):
+        """!
+        Sum the listening time per station, artist or song.
+        An event is counted in the range in which it starts. Its duration is cut off at the end of
+        the range. Only events with sid 6 (playing) are counted.
+        @param column is 'station', 'artist', 'song' or 'device'.
+        @param start is the start of the time range (seconds since the epoch), None for the beginning.
+        @param end is the end of the time range (seconds since the epoch), None for now.
+        @param device is the name of a device to restrict the query to, None for all devices.
+        @return a dict name -> seconds, sorted by seconds (longest first).
+        """
+        lo, hi, times, dev = self._select(start, end, device)
+        if hi <= lo or (device is not None and dev is None):
+            return dict()
+        seconds = self._durations(lo, hi, times, end)
+        keys = self._column(column)
+        sids = self._column('sid')
+        devices = self._column('device')
+        totals = defaultdict(int)
+        if numpy is not None:
+            mask = sids[lo:hi] == 6
+            if dev is not None:
+                mask &= devices[lo:hi] == dev
+            sums = numpy.bincount(keys[lo:hi][mask], weights=seconds[mask])
+            for key in numpy.nonzero(sums)[0]:
+                totals[self._strings[key]] = int(sums[key])
+        else:
+            for offset, index in enumerate(range(lo, hi)):
+                if sids[index] == 6 and (dev is None or devices[index] == dev):
+                    totals[self._strings[keys[index]]] += seconds[offset]
+        return dict(sorted(totals.items(), key=lambda item: -item[1]))
+
+    def status_rates(self, start=None, end=None, device=None):
+        """!
+        Calculate the buffering and failure rates.
+        Returned are the tags:
+         - buffering : the fraction of time spent buffering (sid 2).
+         - failed : the fraction of connection attempts that failed (sid 14 events out of
+                    sid 2 and sid 14 events).
+         - seconds : the total recorded seconds in the range.
+        @param start is the start of the time range (seconds since the epoch), None for the beginning.
+        @param end is the end of the time range (seconds since the epoch), None for now.
+        @param device is the name of a device to restrict the query to, None for all devices.
+        @return a dict holding buffering, failed and seconds.
+        """
+        lo, hi, times, dev = self._select(start, end, device)
+        if hi <= lo or (device is not None and dev is None):
+            return dict(buffering=0.0, failed=0.0, seconds=0)
+        seconds = self._durations(lo, hi, times, end)
+        sids = self._column('sid')
+        devices = self._column('device')
+        if numpy is not None:
+            sid = sids[lo:hi]
+            mask = numpy.ones(hi - lo, dtype=bool) if dev is None else devices[lo:hi] == dev
+            total = int(seconds[mask].sum())
+            buffering = int(seconds[mask & (sid == SID_BUFFERING)].sum())
+            attempts = int(numpy.count_nonzero(mask & ((sid == SID_BUFFERING) | (sid == SID_FAILED))))
+            failures = int(numpy.count_nonzero(mask & (sid == SID_FAILED)))
+        else:
+            total = buffering = attempts = failures = 0
+            for offset, index in enumerate(range(lo, hi)):
+                if dev is not None and devices[index] != dev:
+                    continue
+                total += seconds[offset]
+                if sids[index] == SID_BUFFERING:
+                    buffering += seconds[offset]
+                    attempts += 1
+                elif sids[index] == SID_FAILED:
+                    attempts += 1
+                    failures += 1
+        return dict(buffering=float(buffering) / total if total else 0.0,
+                    failed=float(failures) / attempts if attempts else 0.0,
+                    seconds=total)
+
+    def events(self, start=None, end=None, device=None):
+        """!
+        Return the stored events in a time range.
+        Each event is a dict with the tags time, dur (None while open), device, station, artist,
+        song, sid and vol.
+        @param start is the start of the time range (seconds since the epoch), None for the beginning.
+        @param end is the end of the time range (seconds since the epoch), None for now.
+        @param device is the name of a device to restrict the query to, None for all devices.
+        @return a list of events, oldest first.
+        """
+        lo, hi, times, dev = self._select(start, end, device)
+        columns = dict((name, self._column(name)) for name, _ in COLUMNS)
+        result = []
+        for index in range(lo, hi):
+            if dev is not None and columns['device'][index] != dev:
+                continue
+            event = dict((name, int(columns[name][index])) for name, _ in COLUMNS)
+            for name in ('device', 'station', 'artist', 'song'):
+                event[name] = self._strings[event[name]]
+            if event['dur'] == OPEN:
+                event['dur'] = None
+            result.append(event)
+        return result
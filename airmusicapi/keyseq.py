@@ -0,0 +1,191 @@
+"""
+Remote control key sequences for Airmusic based Internet Radios.
+
+Some menus, like the Configuration menu or the equaliser, have no direct command and can only be
+reached by simulating keys of the InfraRed Remote with send_rc_key(). If keys are sent too fast,
+the device drops some of them; fixed sleeps between the keys are either too slow or too fast.
+
+The keysequence class paces the keys from the measured response time of the device: the pause is
+counted from the moment the previous key was sent, and is never shorter than a round trip.
+Only the volume keys are verified: their effect is read back with get_background_play_status(), the
+pause grows when some were dropped and shrinks again while all are accepted, and only the dropped keys
+are sent again. The device gives no way to read the menu position without moving it, so all other
+keys, eg. menu navigation, count as accepted when the device replies OK to the Sendkey command. They
+are sent at a fixed pace: the pause learned from the volume keys, or min_gap, but at least the
+response time.
+
+A sequence can be given as a list of KEY_... values, or as a symbolic path:
+  keys = keysequence(am_obj)
+  keys.run("SYSTEMMENU > DOWN x3 > ENTER")
+"""
+import logging
+import re
+import time
+from airmusicapi import airmusic
+
+
+# Keys whose effect can be read back with get_background_play_status(): key -> change of vol.
+VOLUME_KEYS = {airmusic.KEY_VOLUP: 1, airmusic.KEY_VOLDOWN: -1}
+
+# The key name is matched non-greedy, so a count can follow it directly, eg. DOWNx3 or BUTTON1x2.
+_STEP = re.compile(r'^\s*(?:KEY_)?([A-Z][A-Z0-9_]*?)\s*(?:[x×*]\s*(\d+))?\s*$', re.IGNORECASE)
+
+
+def parse(path):
+    """!
+    Convert a symbolic key path into a list of key values.
+    The path holds key names (the KEY_... constants without the prefix) separated by '>'.
+    A key can be repeated by appending 'x' and a count, eg. "SYSTEMMENU > DOWN x3 > ENTER".
+    @param path is the symbolic path (string), or a list of key values or names.
+    @return a list of key values.
+    """
+    if isinstance(path, str):
+        path = path.split('>')
+    keys = []
+    for step in path:
+        if isinstance(step, int):
+            keys.append(step)
+            continue
+        match = _STEP.match(step)
+        key = getattr(airmusic, 'KEY_' + match.group(1).upper(), None) if match else None
+        if key is None:
+            raise ValueError("Unknown key in sequence: '{}'".format(step.strip()))
+        keys.extend([key] * int(match.group(2) or 1))
+    return keys
+
+
+class keysequence(object):
+    """
+    This class sends sequences of remote control keys at the pace the device accepts.
+    """
+
+    def __init__(self, api, min_gap=0.05, max_gap=2.0, retries=3):
+        """!
+        Constructor of the key sequence engine.
+        @param api is an Airmusic API instance.
+        @param min_gap is the shortest pause (seconds) between two keys.
+        @param max_gap is the longest pause (seconds) between two keys.
+        @param retries is the maximum number of times a dropped key is sent again.
+        """
+        self.api = api
+        self.min_gap = min_gap
+        self.max_gap = max_gap
+        self.retries = retries
+        self.logger = logging.getLogger("airmusic.keyseq")
+        # Average response time of a Sendkey command, and the pause currently used between keys.
+        self.response_time = None
+        self.gap = min_gap
+
+    def send(self, key):
+        """!
+        Send a single key and measure the response time of the device.
+        @param key is the key value (one of the KEY_... constants).
+        @return True if the device accepted the key.
+        """
+        start = time.monotonic()
+        resp = self.api.send_rc_key(key)
+        elapsed = time.monotonic() - start
+        if self.response_time is None:
+            self.response_time = elapsed
+        else:
+            self.response_time = 0.8 * self.response_time + 0.2 * elapsed
+        return isinstance(resp, dict) and resp.get('rt') == 'OK'
+
+    def _wait(self, since):
+        """!
+        @private
+        Sleep until the pause since the previous key was sent has passed.
+        The pause is never shorter than the average response time of the device. As send() returns
+        after the reply, a round trip has usually passed already and no extra sleep is needed.
+        """
+        gap = max(self.gap, self.response_time or 0)
+        remaining = since + gap - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def _slower(self):
+        """!
+        @private
+        A key was dropped: increase the pause between keys.
+        """
+        self.gap = min(self.max_gap, self.gap * 1.5 + 0.01)
+        self.logger.debug("Key dropped, pause between keys now {:.3f}s".format(self.gap))
+
+    def _faster(self):
+        """!
+        @private
+        Keys were accepted: decrease the pause between keys.
+        """
+        self.gap = max(self.min_gap, self.gap * 0.9)
+
+    def run(self, path):
+        """!
+        Send a sequence of keys.
+        Consecutive volume keys are sent as a group. After the group the volume is read back once,
+        and the keys that were dropped are sent again. Other keys are only checked for an OK reply;
+        whether a navigation key actually moved the menu is not verified, and they do not change
+        the pause unless the device refuses them.
+        Returned are the tags:
+         - sent : the number of keys sent, including the retries,
+         - dropped : the number of keys that had to be sent again,
+         - ok : True if all keys were accepted.
+        @param path is the symbolic path or the list of keys, see parse().
+        @return a dict holding sent, dropped and ok.
+        """
+        keys = parse(path)
+        report = dict(sent=0, dropped=0, ok=True)
+        last = 0.0
+        index = 0
+        while index < len(keys):
+            if keys[index] in VOLUME_KEYS:
+                group = index
+                while group < len(keys) and keys[group] in VOLUME_KEYS:
+                    group += 1
+                last = self._run_volume(keys[index:group], last, report)
+                index = group
+                continue
+            for attempt in range(self.retries + 1):
+                self._wait(last)
+                last = time.monotonic()
+                accepted = self.send(keys[index])
+                report['sent'] += 1
+                if accepted:
+                    self._faster()
+                    break
+                report['dropped'] += 1
+                self._slower()
+            else:
+                self.logger.error("Key {} not accepted after {} retries.".format(keys[index], self.retries))
+                report['ok'] = False
+                return report
+            index += 1
+        return report
+
+    def _run_volume(self, keys, last, report):
+        """!
+        @private
+        Send a group of volume keys and resend the dropped ones.
+        @return the time the last key was sent.
+        """
+        start = int(self.api.get_background_play_status()['vol'])
+        target = max(0, min(15, start + sum(VOLUME_KEYS[key] for key in keys)))
+        pending = keys
+        for attempt in range(self.retries + 1):
+            for key in pending:
+                self._wait(last)
+                last = time.monotonic()
+                self.send(key)
+                report['sent'] += 1
+            # Give the device the time to handle the last key before reading the volume.
+            self._wait(last)
+            vol = int(self.api.get_background_play_status()['vol'])
+            if vol == target:
+                self._faster()
+                return last
+            missing = target - vol
+            report['dropped'] += abs(missing)
+            self._slower()
+            pending = [airmusic.KEY_VOLUP if missing > 0 else airmusic.KEY_VOLDOWN] * abs(missing)
+        self.logger.error("Volume {} not reached after {} retries.".format(target, self.retries))
+        report['ok'] = False
+        return last
@@ -0,0 +1,314 @@
+"""
+Embedded media server for Airmusic based Internet Radios.
+
+The commands LocalPlay (play_remotefile()) and mylogo (send_bootlogo()) need a URL the device can
+fetch the file from. The mediaserver class serves local files over HTTP and hands out those URLs.
+ - Each request is handled in its own thread.
+ - Range requests are supported, so the device can seek in a file or resume a download.
+ - File contents are sent with os.sendfile() where the platform offers it, copying the data
+   directly from the file to the network without passing through Python.
+ - Open file handles are cached, so streaming the same file to many devices opens it only once.
+
+Usage:
+  server = mediaserver()
+  server.start()
+  server.play(am_obj, '/home/me/intercom/msg.wav', name='Intercom')
+  server.bootlogo(am_obj, '/home/me/mylogo.jpg')
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import socket
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import quote, unquote
+
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+_CHUNK = 1024 * 1024
+
+
+class _openfile(object):
+    """!
+    @private
+    A cached open file, shared by all requests for that file.
+    """
+
+    def __init__(self, path):
+        self.handle = open(path, 'rb')
+        stat = os.fstat(self.handle.fileno())
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.users = 0
+        self.evicted = False
+
+
+class mediaserver(object):
+    """
+    This class serves local files to Airmusic devices.
+    """
+
+    def __init__(self, host=None, max_open_files=64):
+        """!
+        Constructor of the media server.
+        @param host is the IP-address or name the devices use to reach this computer. If None, the
+               address of the interface that routes to the device is used.
+        @param max_open_files is the maximum number of file handles kept open.
+        """
+        self.host = host
+        self.max_open_files = max_open_files
+        self.logger = logging.getLogger("airmusic.mediaserver")
+        self._lock = threading.Lock()
+        self._files = dict()  # URL token -> path
+        self._open = OrderedDict()  # path -> _openfile, least recently used first
+        self._server = None
+        self._thread = None
+
+    def start(self, address='', port=0):
+        """!
+        Start serving files in a background thread.
+        @param address is the local address to listen on. Default is all interfaces.
+        @param port is the local port to listen on. Default is any free port.
+        @return the (address, port) the server is listening on.
+        """
+        self._server = _server((address, port), _handler)
+        self._server.media = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name='airmusic-media')
+        self._thread.daemon = True
+        self._thread.start()
+        return self._server.server_address
+
+    def stop(self):
+        """!
+        Stop serving files and close all cached file handles.
+        """
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        with self._lock:
+            for entry in self._open.values():
+                entry.evicted = True
+                if entry.users == 0:
+                    entry.handle.close()
+            self._open.clear()
+
+    def url_for(self, path, device_address=None):
+        """!
+        Publish a local file and return the URL a device can fetch it from.
+        @param path is the name of the local file.
+        @param device_address is the address of the device that will fetch the file. It is used to
+               find the local address to put in the URL, if no host was given to the constructor.
+        @return the URL (string).
+        """
+        path = os.path.abspath(path)
+        token = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+        with self._lock:
+            self._files[token] = path
+        host = self.host or self._local_address(device_address)
+        return 'http://{}:{}/{}/{}'.format(host, self._server.server_address[1], token,
+                                           quote(os.path.basename(path)))
+
+    @staticmethod
+    def _local_address(device_address):
+        """!
+        @private
+        Return the local IP-address used to reach the given device.
+        Connecting a UDP socket sends no packets, but selects the outgoing interface.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.connect((device_address or '192.0.2.1', 80))
+            return sock.getsockname()[0]
+        except OSError:
+            return socket.gethostbyname(socket.gethostname())
+        finally:
+            sock.close()
+
+    def play(self, api, path, name=None):
+        """!
+        Let a device play a local file, see airmusic.play_remotefile().
+        @param api is an Airmusic API instance.
+        @param path is the name of the local audio file.
+        @param name is None if not specified, holds a string to display on the device.
+        @return A dict with the tag rt.
+        """
+        return api.play_remotefile(self.url_for(path, api.device_address), name)
+
+    def bootlogo(self, api, path):
+        """!
+        Send a local image as boot logo to a device, see airmusic.send_bootlogo().
+        @param api is an Airmusic API instance.
+        @param path is the name of the local image file.
+        @return A dict with the tag rt.
+        """
+        return api.send_bootlogo(self.url_for(path, api.device_address))
+
+    def _acquire(self, token):
+        """!
+        @private
+        Return the cached open file for a URL token, opening it if needed; None if unknown.
+        """
+        with self._lock:
+            path = self._files.get(token)
+            if path is None:
+                return None
+            entry = self._open.get(path)
+            if entry is not None and entry.mtime != os.stat(path).st_mtime:
+                self._evict(path)
+                entry = None
+            if entry is None:
+                entry = self._open[path] = _openfile(path)
+                while len(self._open) > self.max_open_files:
+                    self._evict(next(iter(self._open)))
+            self._open.move_to_end(path)
+            entry.users += 1
+            return entry
+
+    def _release(self, entry):
+        """!
+        @private
+        Finish using an open file; close it if it was evicted from the cache meanwhile.
+        """
+        with self._lock:
+            entry.users -= 1
+            if entry.evicted and entry.users == 0:
+                entry.handle.close()
+
+    def _evict(self, path):
+        """!
+        @private
+        Remove an open file from the cache. Must be called with self._lock held.
+        """
+        entry = self._open.pop(path)
+        entry.evicted = True
+        if entry.users == 0:
+            entry.handle.close()
+
+
+class _server(ThreadingMixIn, HTTPServer):
+    """!
+    @private
+    HTTP server handling each device request in its own thread.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _handler(BaseHTTPRequestHandler):
+    """!
+    @private
+    Handle a single request of a device.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        """!
+        @private
+        Send the headers of a file.
+        """
+        self._serve(body=False)
+
+    def do_GET(self):
+        """!
+        @private
+        Send a file, or the requested range of it.
+        """
+        self._serve(body=True)
+
+    def _serve(self, body):
+        """!
+        @private
+        Send the headers and, if requested, the (partial) content of a file.
+        """
+        media = self.server.media
+        parts = self.path.lstrip('/').split('/', 1)
+        try:
+            entry = media._acquire(parts[0])
+        except OSError:
+            entry = None
+        if entry is None:
+            self._error(404, 'Not Found')
+            return
+        try:
+            start, end = 0, entry.size - 1
+            status = 200
+            requested = self.headers.get('Range')
+            if requested:
+                match = _RANGE.match(requested.strip())
+                if match and match.group(1):
+                    start = int(match.group(1))
+                    if match.group(2):
+                        end = min(end, int(match.group(2)))
+                elif match and match.group(2):
+                    start = max(0, entry.size - int(match.group(2)))
+                if not match or start > end or not (match.group(1) or match.group(2)):
+                    self._error(416, 'Range Not Satisfiable',
+                                [('Content-Range', 'bytes */{}'.format(entry.size))])
+                    return
+                status = 206
+            name = unquote(parts[1]) if len(parts) > 1 else ''
+            self.send_response(status)
+            self.send_header('Content-Type', mimetypes.guess_type(name)[0] or 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            if status == 206:
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, entry.size))
+            self.end_headers()
+            if body:
+                self._send_file(entry, start, end - start + 1)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            media._release(entry)
+
+    def _send_file(self, entry, offset, count):
+        """!
+        @private
+        Copy count bytes of the file, starting at offset, to the device.
+        """
+        self.wfile.flush()
+        if hasattr(os, 'sendfile'):
+            out_fd = self.connection.fileno()
+            in_fd = entry.handle.fileno()
+            while count > 0:
+                sent = os.sendfile(out_fd, in_fd, offset, min(count, _CHUNK))
+                if sent == 0:
+                    break
+                offset += sent
+                count -= sent
+            return
+        # Without sendfile the shared handle cannot be used, as reading moves its file position.
+        with open(entry.handle.name, 'rb') as handle:
+            handle.seek(offset)
+            while count > 0:
+                data = handle.read(min(count, _CHUNK))
+                if not data:
+                    break
+                self.wfile.write(data)
+                count -= len(data)
+
+    def _error(self, status, reason, headers=()):
+        """!
+        @private
+        Send an error reply.
+        """
+        body = '<html><body>{} {}</body></html>'.format(status, reason).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """!
+        @private
+        Send the access log to the media server logger instead of stderr.
+        """
+        self.server.media.logger.debug(format % args)
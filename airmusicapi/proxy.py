@@ -0,0 +1,292 @@
+"""
+Multiplexing control proxy for Airmusic based Internet Radios.
+
+The device cannot distinct between commands coming from different applications (the phone App,
+a browser, a script). When these commands interleave, the device gets confused.
+This proxy speaks the protocol of the device: same paths, same Basic Authentication and the same
+responses. All commands are forwarded one at a time through a single connection to the device.
+Identical commands that are in flight at the same moment are sent only once, and replies to
+read-only commands (like playinfo and irdevice.xml) are answered from a short-lived cache.
+
+Usage:
+  ~$ python -m airmusicapi.proxy 192.168.2.147 --port 8000
+
+Applications then use the address of the proxy instead of the device:
+  am = airmusic('localhost', TIMEOUT, port=8000)
+"""
+import argparse
+import base64
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import requests
+from airmusicapi import airmusic
+
+
+# Commands that only read the device state, with the number of seconds a reply may be reused.
+CACHE_TTL = {
+    'playinfo': 1.0,
+    'background_play_status': 1.0,
+    'GetFMStatus': 0.5,
+    'GetBTStatus': 1.0,
+    'irdevice.xml': 60.0,
+    'GetSystemInfo': 30.0,
+    'hotkeylist': 10.0,
+    'DABhotkeylist': 10.0,
+    'GetFMFAVlist': 10.0,
+}
+
+# Commands that give the same result when sent twice. Identical requests for these commands that
+# arrive while one is being handled by the device are answered with that same reply.
+# Commands like Sendkey, back and PlayOP are not in this list: sending them twice has a different
+# effect than sending them once.
+IDEMPOTENT = set(CACHE_TTL) | {'setvol', 'SetFMMode', 'set_dname', 'setfav', 'playhotkey', 'GotoFMfav',
+                               'playDABhotkey', 'play_url', 'mylogo'}
+
+# Commands answered by the proxy itself. The exit command of one application must not end the
+# communication of the other applications with the device.
+LOCAL_REPLIES = {
+    'exit': '<?xml version="1.0" encoding="UTF-8" standalone="yes" ?><result>OK</result>',
+}
+
+
+class _pending(object):
+    """!
+    @private
+    A reply that is awaited by one or more requests.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.reply = None
+        self.error = None
+
+
+class airmusicproxy(object):
+    """
+    This class forwards commands to a single Airmusic device, shared by multiple applications.
+    """
+
+    def __init__(self, device_address, device_port=80, timeout=5):
+        """!
+        Constructor of the proxy.
+        @param device_address holds the device IP-address or resolvable name.
+        @param device_port is the http port of the device.
+        @param timeout determines the maximum amount of seconds to wait for a reply from the device.
+        """
+        self.device_address = device_address
+        self.device_port = device_port
+        self.timeout = timeout
+        self.logger = logging.getLogger("airmusic.proxy")
+        self.session = requests.Session()
+        self.session.auth = airmusic.AUTH
+        self.stats = dict(received=0, forwarded=0, cached=0, shared=0, local=0)
+        self._device_lock = threading.Lock()  # Only one command at a time goes to the device.
+        self._lock = threading.Lock()  # Protects the cache, the pending list and the stats.
+        self._cache = dict()
+        self._inflight = dict()
+        self._server = None
+        self._thread = None
+
+    def forward(self, cmd, query=''):
+        """!
+        Handle one command, either from the cache or by sending it to the device.
+        @param cmd is the command, i.e. the path without the leading '/'.
+        @param query is the raw query string of the request, eg. 'vol=5'.
+        @return a tuple (status code, content type, body as bytes).
+        """
+        key = (cmd, query)
+        with self._lock:
+            self.stats['received'] += 1
+            if cmd in LOCAL_REPLIES:
+                self.stats['local'] += 1
+                return 200, 'text/xml', LOCAL_REPLIES[cmd].encode('utf-8')
+            reply = self._cached(key)
+            if reply is not None:
+                self.stats['cached'] += 1
+                return reply
+            pending = self._inflight.get(key) if cmd in IDEMPOTENT else None
+            if pending is not None:
+                self.stats['shared'] += 1
+            elif cmd in IDEMPOTENT:
+                owner = self._inflight[key] = _pending()
+        if pending is not None:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.reply
+        if cmd not in IDEMPOTENT:
+            return self._send(cmd, query)
+        try:
+            owner.reply = self._send(cmd, query)
+            return owner.reply
+        except requests.RequestException as err:
+            owner.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            owner.event.set()
+
+    def _cached(self, key):
+        """!
+        @private
+        Return the cached reply for the given key if it is still fresh, else None.
+        Must be called with self._lock held.
+        """
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._cache[key]
+            return None
+        return entry[1]
+
+    def _send(self, cmd, query):
+        """!
+        @private
+        Send the command to the device, serialized with all other commands.
+        """
+        url = 'http://{}:{}/{}'.format(self.device_address, self.device_port, cmd)
+        if query:
+            url += '?' + query
+        with self._device_lock:
+            with self._lock:
+                # Another request may have refreshed the cache while we were waiting.
+                reply = self._cached((cmd, query))
+                if reply is not None:
+                    self.stats['cached'] += 1
+                    return reply
+            self.logger.debug("Forwarding: {}".format(url))
+            result = self.session.get(url, timeout=self.timeout)
+            reply = (result.status_code, result.headers.get('Content-Type', 'text/xml'), result.content)
+            with self._lock:
+                self.stats['forwarded'] += 1
+                if cmd in CACHE_TTL:
+                    if result.ok:
+                        self._cache[(cmd, query)] = (time.monotonic() + CACHE_TTL[cmd], reply)
+                else:
+                    # Any other command may change the state of the device.
+                    self._cache.clear()
+        return reply
+
+    def start(self, address='', port=8000):
+        """!
+        Start serving requests in a background thread.
+        @param address is the local address to listen on. Default is all interfaces.
+        @param port is the local port to listen on.
+        @return the (address, port) the proxy is listening on.
+        """
+        self._server = _server((address, port), _handler)
+        self._server.proxy = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name='airmusic-proxy')
+        self._thread.daemon = True
+        self._thread.start()
+        return self._server.server_address
+
+    def serve_forever(self, address='', port=8000):
+        """!
+        Serve requests until interrupted.
+        @param address is the local address to listen on. Default is all interfaces.
+        @param port is the local port to listen on.
+        """
+        self._server = _server((address, port), _handler)
+        self._server.proxy = self
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+    def stop(self):
+        """!
+        Stop serving requests and close the connection to the device.
+        """
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self.session.close()
+
+
+class _server(ThreadingMixIn, HTTPServer):
+    """!
+    @private
+    HTTP server handling each application request in its own thread.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _handler(BaseHTTPRequestHandler):
+    """!
+    @private
+    Handle a single request of an application.
+    """
+    protocol_version = 'HTTP/1.1'
+    authorization = 'Basic ' + base64.b64encode(':'.join(airmusic.AUTH).encode('utf-8')).decode('ascii')
+
+    def do_GET(self):
+        """!
+        @private
+        Check the credentials, forward the command and return the reply of the device.
+        """
+        if self.headers.get('Authorization') != self.authorization:
+            self._reply(401, 'text/html', b'<html><body>401 Unauthorized</body></html>',
+                        [('WWW-Authenticate', 'Basic realm="airmusic"')])
+            return
+        cmd, _, query = self.path.lstrip('/').partition('?')
+        try:
+            status, content_type, body = self.server.proxy.forward(cmd, query)
+        except requests.RequestException as err:
+            self.server.proxy.logger.error("Error forwarding {}: {}".format(cmd, err))
+            self._reply(502, 'text/html', b'<html><body>502 Bad Gateway</body></html>')
+            return
+        self._reply(status, content_type, body)
+
+    def _reply(self, status, content_type, body, headers=()):
+        """!
+        @private
+        Send the response to the application.
+        """
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """!
+        @private
+        Send the access log to the proxy logger instead of stderr.
+        """
+        self.server.proxy.logger.debug(format % args)
+
+
+def main():
+    """
+    Run the proxy from the command line.
+    """
+    parser = argparse.ArgumentParser(description='Share one Airmusic device between applications.')
+    parser.add_argument('device', help='IP-address or hostname of the device')
+    parser.add_argument('--device-port', type=int, default=80, help='http port of the device')
+    parser.add_argument('--address', default='', help='local address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='local port to listen on')
+    parser.add_argument('--timeout', type=float, default=5, help='device timeout in seconds')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    proxy = airmusicproxy(args.device, args.device_port, args.timeout)
+    try:
+        proxy.serve_forever(args.address, args.port)
+    except KeyboardInterrupt:
+        pass
+
+
+# ***************************************************************************
+#                                    MAIN
+# ***************************************************************************
+if __name__ == '__main__':
+    main()
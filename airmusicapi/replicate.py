@@ -0,0 +1,155 @@
+"""
+Replication of favourites from a golden Airmusic device to other devices.
+
+The replicator takes a snapshot of the lists of a golden device (the hotkey list, the FM favourites
+and the DAB hotkey list), compares them with the lists of each target device and writes only the
+positions that differ. All targets are handled in parallel. A target that is already in sync costs
+only the read commands.
+
+Only the hotkey list can be written, with the setfav command (set_favourite()). That command needs
+the song/station ID (eg. 87_114) of the station, which the hotkey list itself does not show.
+Therefore the IDs of the stations in the golden list must be given, by position or by station name.
+Differences in the FM favourites and DAB hotkey lists are reported, as the device offers no command
+to write them.
+
+Usage:
+  rep = replicator(am_golden, sources={1: '87_114', 2: '87_12', 'Radio 1': '91_6'})
+  for report in rep.replicate([am_kitchen, am_bedroom]):
+      print(report['device'], report['ok'], report['written'], report['differs'])
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+
+# List name -> method of the Airmusic API instance that reads it.
+LISTS = (('hotkey', 'get_hotkeylist'), ('fm', 'get_FM_favourites'), ('dab', 'get_DAB_hotkeylist'))
+
+
+def _entries(resp, name):
+    """!
+    @private
+    Convert a list reply into a list of comparable entries, one per position; None if the device
+    returned an error or no list.
+    Empty positions compare equal regardless of the (translated) name the device shows for them.
+    """
+    if not isinstance(resp, dict) or 'item' not in resp:
+        return None
+    items = resp['item']
+    if isinstance(items, dict):
+        items = [items]
+    if name == 'fm':
+        return [item.get('Freq') for item in items]
+    return [(item.get('status'), item.get('name') if item.get('status') == 'file' else None)
+            for item in items]
+
+
+class replicator(object):
+    """
+    This class copies the favourites of a golden device to other devices.
+    """
+
+    def __init__(self, golden, sources=None, lists=('hotkey', 'fm', 'dab'), workers=8):
+        """!
+        Constructor of the replicator. The golden lists are read once, here.
+        @param golden is the Airmusic API instance of the golden device.
+        @param sources is a dict that gives the song/station ID (x_x notation) of the stations in
+               the golden hotkey list, by position (1, 2, ...) or by station name.
+        @param lists holds the names of the lists to compare: 'hotkey', 'fm' and/or 'dab'.
+        @param workers is the maximum number of targets handled at the same time.
+        """
+        self.sources = sources or dict()
+        self.lists = lists
+        self.workers = workers
+        self.logger = logging.getLogger("airmusic.replicate")
+        self.snapshot = self.read(golden)
+
+    def read(self, api):
+        """!
+        Read the lists of a device.
+        @param api is an Airmusic API instance.
+        @return a dict list name -> list of entries (None if the device returned no list).
+        """
+        return dict((name, _entries(getattr(api, method)(), name))
+                    for name, method in LISTS if name in self.lists)
+
+    def diff(self, lists):
+        """!
+        Compare the lists of a target device with the golden snapshot.
+        @param lists is the result of read() for the target device.
+        @return a dict list name -> list of positions (1, 2, ...) that differ.
+        """
+        result = dict()
+        for name, golden in self.snapshot.items():
+            target = lists.get(name)
+            if golden is None:
+                result[name] = []
+            elif target is None:
+                result[name] = list(range(1, len(golden) + 1))
+            else:
+                size = max(len(golden), len(target))
+                result[name] = [pos for pos in range(1, size + 1)
+                                if pos > len(golden) or pos > len(target) or
+                                golden[pos - 1] != target[pos - 1]]
+        return result
+
+    def _source(self, pos):
+        """!
+        @private
+        Return the song/station ID for a position in the golden hotkey list, None if not known.
+        """
+        entry = self.snapshot['hotkey'][pos - 1] if pos <= len(self.snapshot['hotkey']) else None
+        if entry is None or entry[0] != 'file':
+            return None
+        return self.sources.get(pos) or self.sources.get(entry[1])
+
+    def sync(self, api):
+        """!
+        Bring the hotkey list of one target device in line with the golden device.
+        Returned are the tags:
+         - device : the address of the device,
+         - written : the positions of the hotkey list written with setfav,
+         - failed : the positions that could not be written (no song/station ID known, empty in
+                    the golden list, or refused by the device),
+         - differs : the positions per list that still differ after writing,
+         - ok : True if all compared lists are equal to the golden lists.
+        @param api is the Airmusic API instance of the target device.
+        @return a dict holding the report.
+        """
+        differs = self.diff(self.read(api))
+        written = []
+        failed = []
+        for pos in differs.get('hotkey', []):
+            song_id = self._source(pos)
+            if song_id is None:
+                failed.append(pos)
+                continue
+            resp = api.set_favourite(song_id, pos)
+            if isinstance(resp, dict) and resp.get('rt') == 'OK':
+                written.append(pos)
+            else:
+                self.logger.error("{}: setfav {} on {} failed: {}".format(api.device_address, song_id,
+                                                                         pos, resp))
+                failed.append(pos)
+        if written:
+            # Verify the hotkey list only; the other lists were not changed.
+            after = _entries(api.get_hotkeylist(), 'hotkey')
+            differs['hotkey'] = self.diff(dict(hotkey=after))['hotkey'] if after is not None else written
+        return dict(device=api.device_address, written=written, failed=failed, differs=differs,
+                    ok=not any(differs.values()))
+
+    def replicate(self, targets):
+        """!
+        Synchronise several target devices in parallel, see sync().
+        @param targets is a list of Airmusic API instances.
+        @return a list of reports, in the order of targets.
+        """
+        def sync_one(api):
+            try:
+                return self.sync(api)
+            except Exception as err:  # One failing device must not stop the others.
+                self.logger.error("{}: {}".format(api.device_address, err))
+                return dict(device=api.device_address, written=[], failed=[], differs=dict(),
+                            ok=False, error=str(err))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(sync_one, targets))
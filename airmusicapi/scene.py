@@ -0,0 +1,172 @@
+"""
+Scenes for Airmusic based Internet Radios.
+
+A scene describes the desired state of a device, for example:
+  morning = scene(mute=False, volume=6, mode='IRadio', hotkey=2)
+
+When a scene is applied, the current state is read first (init() for the play mode and the hotkey,
+get_background_play_status() for volume, mute and play status). Only the commands needed to reach the
+desired state are sent, in a safe order:
+  (1) mute, if the scene wants the device muted,
+  (2) set the volume (setvol),
+  (3) switch the mode (Sendkey with KEY_INTERNETRADIO or KEY_USB),
+  (4) play the hotkey (playhotkey),
+  (5) unmute, if the scene wants the device unmuted.
+This way a station never starts playing at the old volume. As playhotkey selects the IRadio mode
+itself, KEY_INTERNETRADIO is not sent when a hotkey is played.
+
+Usage:
+  report = morning.apply(am_obj)
+  reports = morning.apply_fleet([am_kitchen, am_bedroom, am_office])
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from airmusicapi import airmusic
+
+
+# Modes that can be selected directly with a key of the remote control.
+MODE_KEYS = {
+    'IRadio': airmusic.KEY_INTERNETRADIO,
+    'USB': airmusic.KEY_USB,
+}
+
+# Values of the sid tag that indicate a song / station is playing, or about to play.
+SID_ACTIVE = ('2', '5', '6', '12')
+
+
+class scene(object):
+    """
+    This class holds the desired state of a device and applies it with the fewest commands.
+    """
+
+    def __init__(self, mute=None, volume=None, mode=None, hotkey=None):
+        """!
+        Constructor of a scene. Parameters that are None are left as they are on the device.
+        @param mute is True to mute the device, False to unmute it.
+        @param volume is the volume level to set (0 .. 15).
+        @param mode is the play mode as reported by init() in PlayMode, eg. 'IRadio' or 'USB'.
+        @param hotkey is the number of the station in the hotkey list to play. Playing a hotkey
+               selects the IRadio mode, so it cannot be combined with another mode.
+        """
+        if mode is not None and mode not in MODE_KEYS:
+            raise ValueError("Mode {} cannot be selected, use one of {}.".format(mode, sorted(MODE_KEYS)))
+        if hotkey is not None and mode not in (None, 'IRadio'):
+            raise ValueError("A hotkey plays in IRadio mode, it cannot be combined with mode {}.".format(mode))
+        self.mute = mute
+        self.volume = volume
+        self.mode = mode
+        self.hotkey = hotkey
+        self.logger = logging.getLogger("airmusic.scene")
+
+    def __repr__(self):
+        """!
+        @private
+        Return a string representation of the scene.
+        """
+        return "scene(mute={}, volume={}, mode={}, hotkey={})".format(self.mute, self.volume,
+                                                                     self.mode, self.hotkey)
+
+    @staticmethod
+    def read_state(api):
+        """!
+        Read the state of a device that a scene can change.
+        Returned are the tags:
+         - mode : the play mode (PlayMode of init()),
+         - hotkey : the key of the chosen station in the hotkey list (hotkey_fav of init()),
+         - vol : the volume level (int),
+         - mute : the mute state (bool),
+         - sid : the play status, see airmusic.SID.
+        @param api is an Airmusic API instance.
+        @return a dict holding the state.
+        """
+        info = api.init(language=api.language or 'en')
+        status = api.get_background_play_status()
+        return dict(mode=info.get('PlayMode'), hotkey=info.get('hotkey_fav'),
+                    vol=int(status['vol']), mute=status['mute'] == '1', sid=status.get('sid'))
+
+    def plan(self, state):
+        """!
+        Determine the commands needed to go from the given state to this scene.
+        @param state is the current state, as returned by read_state().
+        @return a list of (method name, argument) tuples, to be called on the Airmusic API instance.
+        """
+        steps = []
+        switch = self.mode is not None and state['mode'] != self.mode
+        play = self.hotkey is not None and (switch or str(state['hotkey']) != str(self.hotkey) or
+                                            state['sid'] not in SID_ACTIVE)
+        if self.mute is True and not state['mute']:
+            steps.append(('set_mute', True))
+        if self.volume is not None and state['vol'] != self.volume:
+            steps.append(('set_volume', self.volume))
+        if switch and not (play and self.mode == 'IRadio'):
+            # playhotkey selects the IRadio mode itself.
+            steps.append(('send_rc_key', MODE_KEYS[self.mode]))
+        if play:
+            steps.append(('play_hotkey', self.hotkey))
+        if self.mute is False and state['mute']:
+            steps.append(('set_mute', False))
+        return steps
+
+    def apply(self, api, verify=True):
+        """!
+        Bring a device into the state of this scene.
+        Returned are the tags:
+         - device : the address of the device,
+         - sent : the list of (method name, argument) tuples sent,
+         - state : the state of the device after applying the scene,
+         - ok : True if the state matches the scene; None if not verified.
+        @param api is an Airmusic API instance.
+        @param verify is True to check the resulting state of the device.
+        @return a dict holding the report.
+        """
+        state = self.read_state(api)
+        steps = self.plan(state)
+        for method, arg in steps:
+            self.logger.debug("{}: {}({})".format(api.device_address, method, arg))
+            result = getattr(api, method)(arg)
+            if method in ('set_mute', 'set_volume') and isinstance(result, dict):
+                # The setvol command returns the resulting vol and mute levels.
+                state['vol'] = int(result.get('vol', state['vol']))
+                state['mute'] = result.get('mute', '1' if state['mute'] else '0') == '1'
+        report = dict(device=api.device_address, sent=steps, state=state, ok=None)
+        if not verify:
+            return report
+        if any(method in ('send_rc_key', 'play_hotkey') for method, _ in steps):
+            state = report['state'] = self.read_state(api)
+        report['ok'] = self.matches(state)
+        return report
+
+    def matches(self, state):
+        """!
+        Check whether the given state matches this scene.
+        @param state is the state of a device, as returned by read_state().
+        @return True if all items of the scene match.
+        """
+        if self.mute is not None and state['mute'] != self.mute:
+            return False
+        if self.volume is not None and state['vol'] != self.volume:
+            return False
+        if self.mode is not None and state['mode'] != self.mode:
+            return False
+        if self.hotkey is not None and (str(state['hotkey']) != str(self.hotkey) or
+                                        state['sid'] not in SID_ACTIVE):
+            return False
+        return True
+
+    def apply_fleet(self, apis, workers=8, verify=True):
+        """!
+        Apply this scene to several devices in parallel.
+        @param apis is a list of Airmusic API instances.
+        @param workers is the maximum number of devices handled at the same time.
+        @param verify is True to check the resulting state of each device.
+        @return a list of reports (see apply()), in the order of apis.
+        """
+        def apply_one(api):
+            try:
+                return self.apply(api, verify)
+            except Exception as err:  # One failing device must not stop the others.
+                self.logger.error("{}: {}".format(api.device_address, err))
+                return dict(device=api.device_address, sent=[], state=None, ok=False, error=str(err))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(apply_one, apis))
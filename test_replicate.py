@@ -0,0 +1,48 @@
+"""
+Check of the replicator in airmusicapi/replicate.py, with mocked devices.
+"""
+
+
+from unittest import mock
+from airmusicapi.replicate import replicator
+
+
+def hotkeylist(*names):
+    """!
+    Build a reply of get_hotkeylist() holding the given station names; None is an empty position.
+    """
+    return dict(item=[dict(id=str(pos), name=name or 'Empty', status='file' if name else 'emptyfile')
+                      for pos, name in enumerate(names, 1)])
+
+
+def device(address, hotkeys, fm, dab):
+    """!
+    Build a mocked Airmusic API instance that returns the given list replies.
+    """
+    api = mock.Mock(device_address=address)
+    api.get_hotkeylist.side_effect = hotkeys
+    api.get_FM_favourites.return_value = fm
+    api.get_DAB_hotkeylist.return_value = dab
+    api.set_favourite.return_value = dict(rt='OK')
+    return api
+
+
+def test_sync_keeps_other_lists():
+    """
+    After writing the hotkey list, only the hotkey differences are verified again: the equal FM
+    list must stay equal, and the DAB difference that cannot be written must still be reported.
+    """
+    golden = device('golden', [hotkeylist('Radio 1', 'Radio 2')],
+                    dict(item=[dict(Freq='87.50')]), dict(item=[dict(name='DAB 1', status='file')]))
+    target = device('target', [hotkeylist('Radio 1', None), hotkeylist('Radio 1', 'Radio 2')],
+                    dict(item=[dict(Freq='87.50')]), dict(item=[dict(name='DAB 2', status='file')]))
+    rep = replicator(golden, sources={'Radio 2': '87_12'})
+    report = rep.sync(target)
+    target.set_favourite.assert_called_once_with('87_12', 2)
+    assert report['written'] == [2]
+    assert report['differs'] == dict(hotkey=[], fm=[], dab=[1])
+    assert not report['ok']
+
+
+if __name__ == '__main__':
+    test_sync_keeps_other_lists()